@@ -1,13 +1,33 @@
 import yaml
 import os
+import sys
+import logging
+import logging.handlers
+import orjson
+import random
+import time
+import threading
 import requests
 import sqlite3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial, wraps
+from typing import Callable, Collection, Iterable
 from google.cloud import resourcemanager_v3
 from dotenv import load_dotenv
 
 
+# Use libyaml's C dumper when PyYAML was built with it, it is much faster than the pure Python one
+try:
+    from yaml import CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeDumper
+
+
 # Create class so that YAML dumper doesn't create references <eyeroll>
-class NoAliasDumper(yaml.SafeDumper):
+class NoAliasDumper(SafeDumper):
     def ignore_aliases(self, data):
         return True
 
@@ -15,198 +35,429 @@ class NoAliasDumper(yaml.SafeDumper):
 # Global envs
 api_key = ''
 endpoint = ''
+fleet_agents_url = ''
+agent_policies_url = ''
+package_policies_url = ''
 gcp_projects_to_ignore = []
 api_http_headers = {}
 master_agent_policy_name = ''
 gcp_quota_project_name = ''
 gcp_agent_tag_name = ''
 
-# Create a global session object for requests to use HTTP keep-alive
-s = requests.Session()
+# Log records are buffered in memory and written out in batches instead of one write (and flush) per line.
+# Per-project and per-request lines are logged at DEBUG so they are skipped entirely at the default INFO level
+logger = logging.getLogger('gcp-to-fleet-sync')
+
+# Number of GCP projects requested per page when searching for active projects
+gcp_projects_page_size = 500
+
+# Number of Elastic Agents requested per page from Fleet
+fleet_agents_page_size = 1000
+
+# Maximum number of Fleet API calls in flight at once so that Kibana doesn't start rate limiting us
+max_fleet_workers = 16
+
+# Worker threads shared by every concurrent Fleet fan-out during the run, shut down at the end of main()
+fleet_executor = ThreadPoolExecutor(max_workers=max_fleet_workers, thread_name_prefix='fleet')
+
+# Bounds the number of Fleet API calls in flight across all worker threads
+fleet_semaphore = threading.Semaphore(max_fleet_workers)
 
-# Create a global connection to SQLlite3 and connect to the policy.db which contains the revision number last run
-connection = sqlite3.connect(database='policy.db', isolation_level=None)
-cursor = connection.cursor()
+# Maximum number of package policy IDs sent in a single Fleet bulk delete request
+max_bulk_delete_ids = 100
 
-# Global Fleet master integration
-master_agent_policy = {}
+# Keys Fleet sets itself on an integration policy, they are removed from the master integration to make the template
+prep_integration_policy_keys = frozenset(["id", "version", "revision", "created_at", "created_by", "updated_at",
+                                          "updated_by"])
+
+# Kibana responses that are worth retrying (rate limited or a transient server error)
+retryable_status_codes = (429, 500, 502, 503, 504)
+
+# Methods that can safely be sent again after a server error, the request may have been applied before it failed
+idempotent_methods = frozenset(["GET", "HEAD", "PUT", "DELETE"])
+
+# Longest time in seconds to wait for a Retry-After from Kibana, a larger value would tie up a worker for that long
+max_retry_after = 30
+
+# (connect, read) timeouts in seconds for Fleet API calls so a hung socket can't hold a pooled connection forever
+fleet_timeout = (5, 30)
+
+# Create a global session object for requests to use HTTP keep-alive.  The pool is sized to twice the number of
+# concurrent workers so that they always reuse kept-alive connections instead of opening new TLS sessions.
+# urllib3 only retries failures to connect here.  It would otherwise act on a 413, 429 or 503 that carries a
+# Retry-After by itself, so that and retrying on the HTTP status are both turned off and left to with_retry()
+s = requests.Session()
+fleet_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=max_fleet_workers * 2,
+                            max_retries=Retry(total=5, read=False, status=0, respect_retry_after_header=False,
+                                              backoff_factor=0.5))
+s.mount('https://', fleet_adapter)
+s.mount('http://', fleet_adapter)
+
+# SQL used against policy.db.  The statements are always executed with these exact strings so that the
+# sqlite3 statement cache hits and they are only compiled once
+sql_create_policy_table = 'CREATE TABLE IF NOT EXISTS policy(revision INTEGER)'
+sql_select_revision = 'SELECT revision FROM policy LIMIT 1'
+sql_upsert_revision = ('INSERT INTO policy(rowid, revision) VALUES(1, ?) '
+                       'ON CONFLICT(rowid) DO UPDATE SET revision = excluded.revision')
+sql_create_template_table = ('CREATE TABLE IF NOT EXISTS master_template(policy_id TEXT, revision INTEGER, '
+                             'integration_template BLOB)')
+sql_select_template = 'SELECT integration_template FROM master_template WHERE policy_id = ? AND revision = ?'
+sql_upsert_template = ('INSERT INTO master_template(rowid, policy_id, revision, integration_template) '
+                       'VALUES(1, ?, ?, ?) ON CONFLICT(rowid) DO UPDATE SET policy_id = excluded.policy_id, '
+                       'revision = excluded.revision, integration_template = excluded.integration_template')
+
+# Create a global connection to SQLlite3 and connect to the policy.db which contains the revision number last run.
+# It also keeps the integration template built from the most recently fetched master policy.
+# The tables are created once here rather than on every check of the revision.  Every statement autocommits, WAL with
+# synchronous=NORMAL keeps those commits from each forcing an fsync of the database file
+connection = sqlite3.connect(database='policy.db', isolation_level=None, cached_statements=128)
+connection.execute('PRAGMA journal_mode=WAL')
+connection.execute('PRAGMA synchronous=NORMAL')
+connection.execute(sql_create_policy_table)
+connection.execute(sql_create_template_table)
+
+# Master policy revision that the last run synchronized to, None before the first run.  It is read from the db once
+# by load_master_policy_revision() and kept in step with it by save_master_policy_revision()
+saved_master_policy_revision = None
 
 
 # Create a local SQLLite3 db to store the revision of the master policy.  During each run we will compare
 # the revision that is in the master policy to the one stored in the DB. If newer it updates the integrations
-# for each GCP project with the one defined in the master policy
+# for each GCP project with the one defined in the master policy.  On the first run there is no stored revision
+# yet, nothing is updated and the revision is recorded by save_master_policy_revision()
 def is_master_policy_updated(current_revision):
-    cursor.execute('CREATE TABLE IF NOT EXISTS policy(revision INTEGER)')
-    rows = cursor.execute('SELECT revision FROM policy').fetchall()
-    if not rows:
-        cursor.execute('INSERT INTO policy VALUES(:revision)', (current_revision,))
-        return False
-    elif rows[0][0] == current_revision:
-        return False
-    else:
-        return True
+    return saved_master_policy_revision is not None and saved_master_policy_revision != current_revision
 
 
-# Retrieve an active list of GCP projects from the configured organization
-def get_active_gcp_projects(quota_project_id: str):
-    resource_manager_client = resourcemanager_v3.ProjectsClient(
+# Read the stored master policy revision into memory, this is the only time the db is read
+def load_master_policy_revision():
+    global saved_master_policy_revision
+    row = connection.execute(sql_select_revision).fetchone()
+    saved_master_policy_revision = row[0] if row else None
+
+
+# Record the master policy revision this run synchronized to, in memory and in the db.  The table holds a single
+# row, so one UPSERT on it covers both the first run and every run after it
+def save_master_policy_revision(revision: int):
+    global saved_master_policy_revision
+    connection.execute(sql_upsert_revision, (revision,))
+    saved_master_policy_revision = revision
+
+
+# Returns the integration template stored for a revision of the master policy, None if it isn't stored.  The
+# revision alone isn't enough, a different or recreated master policy can have the same revision number
+def load_integration_template(policy_id: str, revision: int):
+    row = connection.execute(sql_select_template, (policy_id, revision)).fetchone()
+    return orjson.loads(row[0]) if row else None
+
+
+# Store the integration template built from a revision of the master policy.  Only the latest one is kept
+def save_integration_template(policy_id: str, revision: int, integration_template: dict):
+    connection.execute(sql_upsert_template, (policy_id, revision, orjson.dumps(integration_template)))
+
+
+# Creating the resource manager client does credential discovery and sets up a gRPC channel, so it is created once
+# per quota project and reused
+@lru_cache(maxsize=None)
+def get_resource_manager_client(quota_project_id: str):
+    return resourcemanager_v3.ProjectsClient(
         client_options={
             "quota_project_id": quota_project_id
         })
-    projects = resource_manager_client.search_projects(query='lifecycleState: ACTIVE')
-    return projects
 
 
-# Get list of Elastic Agents by a query string
+# Retrieve the set of active GCP project IDs from the configured organization.  The pager fetches the pages one
+# after another as it is iterated, so ask for large pages to keep the number of sequential round-trips down.
+# The IDs are collected in a single pass over the pager, a set is all the diffs need since project IDs are unique
+def get_active_gcp_projects(quota_project_id: str):
+    resource_manager_client = get_resource_manager_client(quota_project_id=quota_project_id)
+    projects = resource_manager_client.search_projects(request={"query": 'lifecycleState: ACTIVE',
+                                                                "page_size": gcp_projects_page_size})
+    return {project.project_id for project in projects}
+
+
+# Returns whether a Fleet API response is worth retrying.  A request that isn't idempotent, like creating an
+# integration, may already have been applied when a server error comes back, sending it again would then fail with
+# a conflict.  So it is only retried when Kibana turned it away before handling it: rate limited, or unavailable
+# and saying when to come back
+def is_retryable(r: requests.Response, idempotent: bool):
+    if r.status_code not in retryable_status_codes:
+        return False
+    return idempotent or r.status_code == 429 or (r.status_code == 503 and 'Retry-After' in r.headers)
+
+
+# Retries a Fleet API call while Kibana responds with a retryable status code.  Between attempts it sleeps
+# for the Retry-After Kibana sent (at most max_retry_after), or else a random (jittered) exponential backoff so that
+# concurrent workers don't all retry at the same moment.  The last response is returned once the attempts are used
+# up.  Unless told otherwise, a request is treated as idempotent by its method
+def with_retry(max_attempts: int = 5, base: float = 0.5):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(method: str, url: str, idempotent: bool = None, **kwargs):
+            if idempotent is None:
+                idempotent = method in idempotent_methods
+            for attempt in range(1, max_attempts + 1):
+                r = func(method, url, **kwargs)
+                if attempt == max_attempts or not is_retryable(r, idempotent):
+                    return r
+                retry_after = r.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    time.sleep(min(int(retry_after), max_retry_after))
+                else:
+                    time.sleep(random.uniform(0, base * 2 ** attempt))
+        return wrapper
+    return decorator
+
+
+# Send a request to the Fleet API.  The semaphore is only held while the request is in flight, not while
+# backing off, so a worker waiting to retry doesn't stop the others
+@with_retry(max_attempts=5, base=0.5)
+def fleet_request(method: str, url: str, **kwargs):
+    with fleet_semaphore:
+        return s.request(method=method, url=url, timeout=fleet_timeout, **kwargs)
+
+
+# Get list of active Elastic Agents by a query string.  Fleet pages the agents (20 per page by default), so ask
+# for large pages and keep fetching until every matching agent has been returned
 def get_fleet_agents_by_query(query: str):
-    url = f"{endpoint}/api/fleet/agents"
-    r = s.get(url=url, headers=api_http_headers, params={"kuery": query})
-    if r.status_code == 200:
-        return r.json()
+    url = fleet_agents_url
+    agents = []
+    page = 1
+    while True:
+        r = fleet_request('GET', url=url, params={"kuery": query, "perPage": fleet_agents_page_size, "page": page,
+                                                  "showInactive": "false"})
+        r.raise_for_status()
+        response = orjson.loads(r.content)
+        agents.extend(response['list'])
+        if not response['list'] or len(agents) >= response['total']:
+            return {'list': agents}
+        page += 1
 
 
 # Get Elastic Agent Policy
 def get_agent_policy(policy_id: str):
-    url = f"{endpoint}/api/fleet/agent_policies/{policy_id}"
-    r = s.get(url=url, headers=api_http_headers)
-    if r.status_code == 200:
-        return r.json()
+    url = f"{agent_policies_url}/{policy_id}"
+    r = fleet_request('GET', url=url)
+    r.raise_for_status()
+    return orjson.loads(r.content)
 
 
 # Get Agent Policy by query
 def get_policy_by_query(query: dict):
-    url = f"{endpoint}/api/fleet/agent_policies"
-    r = s.get(url=url, headers=api_http_headers, params=query)
-    if r.status_code == 200:
-        return r.json()
+    url = agent_policies_url
+    r = fleet_request('GET', url=url, params=query)
+    r.raise_for_status()
+    return orjson.loads(r.content)
 
 
-# Removes keys that are not needed when creating or updated integration policy
+# Returns a copy of the integration policy without the keys that are not needed when creating or updating an
+# integration policy.  The policy it is given is left untouched
 def prep_integration_policy(integration_policy: dict):
-    # define the keys to remove
-    keys = ["id", "version", "revision", "created_at", "created_by", "updated_at", "updated_by"]
-    # Remove keys from the master integration policy
-    for key in keys:
-        integration_policy.pop(key, None)
-    return integration_policy
+    return {k: v for k, v in integration_policy.items() if k not in prep_integration_policy_keys}
+
+
+# Returns a function that builds the integration policy for a GCP project and agent policy from the integration
+# template.  Only the dicts on the path to the three fields that change per project are copied, everything else is
+# shared with the template.  Nothing modifies the template or the policies built from it, they are only
+# serialized, so the function can be shared by the concurrent workers
+def get_integration_policy_builder(integration_template: dict):
+    template_vars = integration_template['vars']
+
+    def build_integration_policy(gcp_project_id: str, agent_policy_id: str):
+        return {**integration_template,
+                'policy_id': agent_policy_id,
+                'name': gcp_project_id,
+                'vars': {**template_vars,
+                         'project_id': {**template_vars['project_id'], 'value': gcp_project_id}}}
+
+    return build_integration_policy
 
 
 # Creates an integration policy for a given GCP project and agent policy.
-def create_integration_policy(gcp_project_id: str, agent_policy_id: str, integration_policy: dict):
-    integration_policy['policy_id'] = agent_policy_id
-    integration_policy['name'] = gcp_project_id
-    integration_policy['vars']['project_id']['value'] = gcp_project_id
-    integration_policy = prep_integration_policy(integration_policy)
-    url = f'{endpoint}/api/fleet/package_policies'
-    r = s.post(url=url, headers=api_http_headers, json=integration_policy)
-    check_http_status_code(r.status_code, 'Create integration policy')
+def create_integration_policy(gcp_project_id: str, agent_policy_id: str,
+                              build_integration_policy: Callable[[str, str], dict]):
+    integration_policy = build_integration_policy(gcp_project_id, agent_policy_id)
+    url = package_policies_url
+    r = fleet_request('POST', url=url, data=orjson.dumps(integration_policy))
+    r.raise_for_status()
+    logger.debug('Create integration policy %s succeeded', gcp_project_id)
 
 
 # This function deploys an integration to an agent_policy.  The integration definition comes from
 # the integration deployed to the master agent policy defined in the .env file.
-# There should be ONLY ONE master integration defined in the master agent policy
-def deploy_integration(agent_policy_id: str, gcp_project_id: str):
-    # Grab the master agent policy
-    mp = get_master_policy()
-    # Should be only 1 GCP integration deployed
-    master_integration_policy = mp['items'][0]['package_policies'][0]
-    create_integration_policy(gcp_project_id=gcp_project_id,
-                              agent_policy_id=agent_policy_id,
-                              integration_policy=master_integration_policy)
+# There should be ONLY ONE master integration defined in the master agent policy.
+# A failure is logged rather than raised so that it doesn't stop the other projects, returns whether it succeeded
+def deploy_integration(gcp_project_id: str, agent_policy_id: str,
+                       build_integration_policy: Callable[[str, str], dict]):
+    logger.debug('Creating integrations for GCP Project: %s', gcp_project_id)
+    try:
+        create_integration_policy(gcp_project_id=gcp_project_id,
+                                  agent_policy_id=agent_policy_id,
+                                  build_integration_policy=build_integration_policy)
+    except requests.RequestException as e:
+        logger.error('Create integration policy %s failed: %s', gcp_project_id, e)
+        return False
+    return True
 
 
-def delete_integration_policy(package_policy_id: str):
-    url = f"{endpoint}/api/fleet/package_policies/{package_policy_id}"
-    r = s.delete(url=url, headers=api_http_headers)
-    check_http_status_code(r.status_code, 'Delete integration policy')
+# Deletes integration policies with Fleet's bulk delete endpoint, one request per batch of IDs rather than
+# one request per integration.  A failed batch doesn't stop the ones after it, returns whether every delete succeeded
+def delete_integration_policies(package_policy_ids: list):
+    url = f"{package_policies_url}/delete"
+    succeeded = True
+    for i in range(0, len(package_policy_ids), max_bulk_delete_ids):
+        batch = package_policy_ids[i:i + max_bulk_delete_ids]
+        # Deleting the same integrations again is harmless, so the batch is retried like any idempotent request
+        try:
+            r = fleet_request('POST', url=url, data=orjson.dumps({"packagePolicyIds": batch, "force": True}),
+                              idempotent=True)
+            r.raise_for_status()
+        except requests.RequestException as e:
+            logger.error('Delete integration policies %s failed: %s', batch, e)
+            succeeded = False
+            continue
+        # The bulk endpoint answers 200 even if some of the deletes failed, so report each one.  A failed delete
+        # is tried again on the next run since its GCP project is still gone
+        for result in orjson.loads(r.content):
+            if result['success']:
+                logger.debug('Delete integration policy %s succeeded', result.get('name', result['id']))
+            else:
+                logger.error('Delete integration policy %s failed: %s', result.get('name', result['id']),
+                             result.get('body', {}).get('message', result.get('statusCode')))
+                succeeded = False
+    return succeeded
+
+
+def update_integration_policy(gcp_project_id: str, agent_policy_id: str, package_policy_id: str,
+                              build_integration_policy: Callable[[str, str], dict]):
+    integration_policy = build_integration_policy(gcp_project_id, agent_policy_id)
+    url = f"{package_policies_url}/{package_policy_id}"
+    r = fleet_request('PUT', url=url, data=orjson.dumps(integration_policy))
+    r.raise_for_status()
+    logger.debug('Update integration policy %s succeeded', gcp_project_id)
+
+
+# This function redeploys the integration of a GCP project from the master integration, replacing the
+# integration policy already on the agent policy.  Like deploy_integration() a failure is logged, not raised,
+# and it returns whether it succeeded
+def redeploy_integration(gcp_project_id: str, agent_policy_id: str, agent_gcp_projects: dict,
+                         build_integration_policy: Callable[[str, str], dict]):
+    logger.debug('Updating integrations for GCP Project: %s', gcp_project_id)
+    try:
+        update_integration_policy(gcp_project_id=gcp_project_id,
+                                  agent_policy_id=agent_policy_id,
+                                  package_policy_id=agent_gcp_projects[gcp_project_id],
+                                  build_integration_policy=build_integration_policy)
+    except requests.RequestException as e:
+        logger.error('Update integration policy %s failed: %s', gcp_project_id, e)
+        return False
+    return True
+
+
+# Get the master agent policy.  The summary is enough for its revision, only ask for the full policy, which embeds
+# every integration in it, when the integration template is needed
+def get_master_policy(full: bool = False):
+    query = {"kuery": f'name:"{master_agent_policy_name}"'}
+    if full:
+        query["full"] = "true"
+    mp = get_policy_by_query(query=query)
+    return mp['items'][0]
 
 
-def update_integration_policy(gcp_project_id: str, agent_policy_id: str, package_policy_id: str):
+# The master integration, minus the keys Fleet sets itself, is the template for every GCP project's integration
+def get_integration_template(master_agent_policy: dict):
     # Should be only 1 GCP integration deployed
-    mp = get_master_policy()
-    master_integration_policy = mp['items'][0]['package_policies'][0]
-    master_integration_policy['policy_id'] = agent_policy_id
-    master_integration_policy['name'] = gcp_project_id
-    master_integration_policy['vars']['project_id']['value'] = gcp_project_id
-    integration_policy = prep_integration_policy(integration_policy=master_integration_policy)
-    url = f"{endpoint}/api/fleet/package_policies/{package_policy_id}"
-    r = s.put(url=url, headers=api_http_headers, json=integration_policy)
-    check_http_status_code(r.status_code, 'Updated integration policy')
-
-
-def check_http_status_code(status_code: int, message: str):
-    if status_code == 200:
-        print(f'{message} succeeded\n')
-    else:
-        print(f'{message} failed\n')
-
-
-def get_master_policy_revision():
-    # Grab the master agent policy
-    mp = get_master_policy()
-    # grab the revision
-    return mp["items"][0]['revision']
-
-
-def get_master_policy():
-    global master_agent_policy
-    if not master_agent_policy:
-        master_agent_policy = get_policy_by_query(query={"kuery": f'name:"{master_agent_policy_name}"', "full": "true"})
-    return master_agent_policy
-
-
-def sync_master_integration(agent_policy_id: str, agent_gcp_projects: dict, deleted_gcp_projects: list):
-    # If the master integration has been modified we need to update the existing
-    master_policy_revision = get_master_policy_revision()
-    master_agent_policy_updated = is_master_policy_updated(master_policy_revision)
-    if master_agent_policy_updated:
+    master_integration_policy = master_agent_policy['package_policies'][0]
+    return prep_integration_policy(master_integration_policy)
+
+
+# Returns the integration policy builder for this run.  It is built the first time an integration has to be created
+# or updated and reused after that, a run with no new GCP projects and an unchanged master policy never needs it.
+# The template is stored in the db along with the id and revision of the master policy it came from, so the full
+# master agent policy is only fetched when it is a different policy or its revision has changed since then
+@lru_cache(maxsize=1)
+def get_master_integration_policy_builder(master_policy_id: str, master_policy_revision: int):
+    integration_template = load_integration_template(master_policy_id, master_policy_revision)
+    if integration_template is None:
+        master_agent_policy = get_master_policy(full=True)
+        integration_template = get_integration_template(master_agent_policy)
+        save_integration_template(master_agent_policy['id'], master_agent_policy['revision'], integration_template)
+    return get_integration_policy_builder(integration_template)
+
+
+# Returns whether every integration that needed updating was updated
+def sync_master_integration(agent_policy_id: str, agent_gcp_projects: dict, deleted_gcp_projects: list,
+                            master_policy_id: str, master_policy_revision: int):
+    # Nothing to do, and nothing to write back, if the master integration hasn't changed since the last run
+    if master_policy_revision == saved_master_policy_revision:
+        logger.info('Master integration policy was not changed')
+        return True
+
+    # If the master integration has been modified we need to update the existing integrations.  On the first run
+    # there is no revision to compare against, so it is only recorded
+    if is_master_policy_updated(master_policy_revision):
         # Find remaining integrations because we have to update them with a new master integration version.
-        remaining_gcp_projects = get_list_diffs(primary_list=[*agent_gcp_projects],
+        remaining_gcp_projects = get_list_diffs(primary_list=agent_gcp_projects,
                                                 secondary_list=deleted_gcp_projects)
         # Remove projects we have been told to skip (if any)
         remaining_gcp_projects = get_list_diffs(primary_list=remaining_gcp_projects,
                                                 secondary_list=gcp_projects_to_ignore)
-        print(f'Master integration policy updated, syncing the following GCP projects: {remaining_gcp_projects}\n')
+        logger.info('Master integration policy updated, syncing the following GCP projects: %s', remaining_gcp_projects)
         if gcp_projects_to_ignore:
-            print(f'  Skipping synchronization of the following projects due to configuration: {gcp_projects_to_ignore}\n')
-        for project in remaining_gcp_projects:
-            update_integration_policy(gcp_project_id=project,
-                                      agent_policy_id=agent_policy_id,
-                                      package_policy_id=agent_gcp_projects[project])
-    else:
-        print('Master integration policy was not changed')
-
-    cursor.execute('UPDATE policy SET revision = ?', (master_policy_revision,))
+            logger.info('  Skipping synchronization of the following projects due to configuration: %s',
+                        gcp_projects_to_ignore)
+        # The updates are independent of each other so they are sent concurrently.  With no integrations left to
+        # update the full master agent policy isn't needed, only the new revision is recorded
+        if remaining_gcp_projects:
+            build_integration_policy = get_master_integration_policy_builder(master_policy_id, master_policy_revision)
+            results = run_concurrently(partial(redeploy_integration,
+                                               agent_policy_id=agent_policy_id,
+                                               agent_gcp_projects=agent_gcp_projects,
+                                               build_integration_policy=build_integration_policy),
+                                       remaining_gcp_projects)
+            # Leave the stored revision alone if any update failed, so the next run tries all of them again
+            if not all(results):
+                return False
+
+    save_master_policy_revision(master_policy_revision)
+    return True
 
 
-def delete_integrations_by_gcp_project_id(agent_gcp_projects: dict, active_gcp_projects: list):
+# Returns the GCP projects whose integrations were deleted and whether every delete succeeded
+def delete_integrations_by_gcp_project_id(agent_gcp_projects: dict, active_gcp_projects: set):
     # Find projects configured in fleet that point to GCP projects that don't exist anymore
-    deleted_gcp_projects = get_list_diffs(primary_list=[*agent_gcp_projects],
+    deleted_gcp_projects = get_list_diffs(primary_list=agent_gcp_projects,
                                           secondary_list=active_gcp_projects)
     # Remove projects we have been told to skip (if any)
     deleted_gcp_projects = get_list_diffs(primary_list=deleted_gcp_projects,
                                           secondary_list=gcp_projects_to_ignore)
-    print(f'Old GCP Projects found that need integrations deleted in the agent policy: {deleted_gcp_projects}\n')
+    logger.info('Old GCP Projects found that need integrations deleted in the agent policy: %s', deleted_gcp_projects)
     if gcp_projects_to_ignore:
-        print(f'  Skipping deletion of the following projects due to configuration: {gcp_projects_to_ignore}\n')
-    # Loop through *deleted* GCP projects and for each one delete the integration on each
-    # agent listening to GCP telemetry
-    for project in deleted_gcp_projects:
-        print(f'Deleting all integrations for GCP Project: {project}\n')
-        delete_integration_policy(package_policy_id=agent_gcp_projects[project])
-    return deleted_gcp_projects
-
-
-def create_integrations_by_gcp_project_id(agent_policy_id: str, agent_gcp_projects: dict, active_gcp_projects: list):
-    # Find GCP projects that don't have an Elastic Integration. Used * to convert to a list
+        logger.info('  Skipping deletion of the following projects due to configuration: %s', gcp_projects_to_ignore)
+    # Delete the integration for every *deleted* GCP project on the agent policy listening to GCP telemetry.
+    # The deletes are batched into as few bulk requests as possible, each one is logged from the results
+    if not deleted_gcp_projects:
+        return deleted_gcp_projects, True
+    succeeded = delete_integration_policies([agent_gcp_projects[project] for project in deleted_gcp_projects])
+    return deleted_gcp_projects, succeeded
+
+
+# Returns whether every new integration was created
+def create_integrations_by_gcp_project_id(agent_policy_id: str, agent_gcp_projects: dict, active_gcp_projects: set,
+                                          master_policy_id: str, master_policy_revision: int):
+    # Find GCP projects that don't have an Elastic Integration.  The dict is passed as is, its keys are the projects
     new_gcp_projects = get_list_diffs(primary_list=active_gcp_projects,
-                                      secondary_list=[*agent_gcp_projects])
-    print(f"New GCP Projects found that need integrations added to the agent policy: {new_gcp_projects}\n")
-    # Loop through *new* GCP projects and for each one deploy an integration to the
-    # agent policy listening to GCP telemetry
-    for project in new_gcp_projects:
-        print(f"Creating integrations for GCP Project: {project}\n")
-        deploy_integration(agent_policy_id=agent_policy_id, gcp_project_id=project)
+                                      secondary_list=agent_gcp_projects)
+    logger.info('New GCP Projects found that need integrations added to the agent policy: %s', new_gcp_projects)
+    if not new_gcp_projects:
+        return True
+    # Deploy an integration for each *new* GCP project to the agent policy listening to GCP telemetry.
+    # The deploys are independent of each other so they are sent concurrently
+    build_integration_policy = get_master_integration_policy_builder(master_policy_id, master_policy_revision)
+    results = run_concurrently(partial(deploy_integration,
+                                       agent_policy_id=agent_policy_id,
+                                       build_integration_policy=build_integration_policy), new_gcp_projects)
+    return all(results)
 
 
 def inspect_agent_policy():
@@ -217,133 +468,195 @@ def inspect_agent_policy():
     # Get a list of agents that are listening to GCP telemetry
     agents = get_fleet_agents_by_query(query=f'tags:"{gcp_agent_tag_name}"')
 
-    # Add agent info to policy hierarchy so the end user knows where the policy is deployed
-    for agent in agents['list']:
-        policy_hierarchy['agent_policy']['agents'].append({'hostname': agent['local_metadata']['host']['hostname'],
-                                                           'version': agent['agent']['version']})
+    # Add agent info to policy hierarchy so the end user knows where the policy is deployed.  The agent policies
+    # are collected in the same pass so the agents don't have to be walked again
+    agent_list = agents['list']
+    hierarchy_agents = policy_hierarchy['agent_policy']['agents']
+    agent_policy_ids = set()
+    for agent in agent_list:
+        hierarchy_agents.append({'hostname': agent['local_metadata']['host']['hostname'],
+                                 'version': agent['agent']['version']})
+        agent_policy_ids.add(agent['policy_id'])
     # Grab the first agent and get the policy
-    agent = agents['list'][0]
-    agent_policy_id = agent['policy_id']
-    policy = get_agent_policy(policy_id=agent_policy_id)
+    agent_policy_id = agent_list[0]['policy_id']
+    if len(agent_policy_ids) > 1:
+        logger.warning('Agents tagged %s are enrolled in %d agent policies, only %s will be synchronized',
+                       gcp_agent_tag_name, len(agent_policy_ids), agent_policy_id)
+    policy_item = get_agent_policy(policy_id=agent_policy_id)['item']
 
     # Start to build the hierarchy of integrations for the agent policy, so they can be displayed/logged
-    policy_hierarchy['agent_policy']['revision'] = policy['item']['revision']
-    policy_hierarchy['agent_policy']['name'] = policy['item']['name']
+    policy_hierarchy['agent_policy']['revision'] = policy_item['revision']
+    policy_hierarchy['agent_policy']['name'] = policy_item['name']
 
     agent_gcp_projects = {}
+    # Integrations in the policy hierarchy keyed by name, each with its datatypes keyed by type
+    integrations_by_name = {}
     # Loop through the policy and get all the integrations (inputs)
-    for pp in policy['item']['package_policies']:
+    for pp in policy_item['package_policies']:
         # Check to see if this integration is a GCP integration
         if 'gcp' == pp['package']['name']:
             integration_name = pp['name']
             gcp_project_name = pp['vars']['project_id']['value']
             package_policy_id = pp['id']
-            for inp in pp['inputs']:
-                if inp['enabled']:
-                    # I have never seen more than 1 stream for GCP, it doesn't appear to be settable in the UI
-                    stream = inp['streams'][0]
-                    stream_datatype = stream['data_stream']['type']
-                    stream_dataset = stream['data_stream']['dataset']
-                    # Check to see if the GCP project is already listed in the policy_hierarchy, if so return it
-                    # if not return None
-                    integration = is_kv_in_list_dicts(target_list=policy_hierarchy['agent_policy']['integrations'],
-                                                      key='name',
-                                                      value=integration_name)
-                    if integration is not None:  # GCP project not found in policy hierarchy
-                        datatype = is_key_in_list_dicts(target_list=integration['datatype'], key=stream_datatype)
-                        if datatype is None:
-                            integration['datatype'].append({stream_datatype: {'dataset': [stream_dataset]}})
-                        else:
-                            datatype[stream_datatype]['dataset'].append(stream_dataset)
-                    else:
-                        integration = {'name': integration_name,
-                                       'id': package_policy_id,
-                                       'gcp_project': gcp_project_name,
-                                       'datatype': [{stream_datatype: {'dataset': [stream_dataset]}}]}
-                        policy_hierarchy['agent_policy']['integrations'].append(integration)
-
-                    # Add package_policy_id to dict in case we need to delete the integration later
-                    if gcp_project_name not in agent_gcp_projects.keys():
-                        agent_gcp_projects[gcp_project_name] = package_policy_id
-
-    # Create a yaml representation of the policy_hierarchy as it is much easier to read
-    policy_hierarchy_yaml = yaml.dump(policy_hierarchy, allow_unicode=True, default_flow_style=False,
-                                      sort_keys=False, Dumper=NoAliasDumper)
-    print(f'Found the following agent policy:\n{policy_hierarchy_yaml}\n')
+            # Integrations without any enabled inputs aren't collecting anything, leave them alone
+            enabled_inputs = [inp for inp in pp['inputs'] if inp['enabled']]
+            if not enabled_inputs:
+                continue
+
+            # Add package_policy_id to dict in case we need to delete the integration later.  The first
+            # integration seen for a GCP project wins.  Every stream of the integration belongs to the same
+            # GCP project, so this is done once per integration rather than once per stream
+            agent_gcp_projects.setdefault(gcp_project_name, package_policy_id)
+
+            # Look up the integration by key rather than scanning the list of them
+            integration = integrations_by_name.get(integration_name)
+            if integration is None:  # Integration not found in policy hierarchy
+                integration = {'name': integration_name,
+                               'id': package_policy_id,
+                               'gcp_project': gcp_project_name,
+                               'datatype': defaultdict(lambda: {'dataset': []})}
+                integrations_by_name[integration_name] = integration
+
+            for inp in enabled_inputs:
+                # I have never seen more than 1 stream for GCP, it doesn't appear to be settable in the UI
+                stream = inp['streams'][0]
+                stream_datatype = stream['data_stream']['type']
+                stream_dataset = stream['data_stream']['dataset']
+                integration['datatype'][stream_datatype]['dataset'].append(stream_dataset)
+
+    # The policy hierarchy is only displayed, so skip building and serializing it if INFO isn't being logged
+    if logger.isEnabledFor(logging.INFO):
+        # Display the integrations, and each integration's datatypes, as lists in the policy hierarchy
+        policy_hierarchy['agent_policy']['integrations'] = [
+            {**integration, 'datatype': [{k: v} for k, v in integration['datatype'].items()]}
+            for integration in integrations_by_name.values()]
+
+        # Create a yaml representation of the policy_hierarchy as it is much easier to read
+        policy_hierarchy_yaml = yaml.dump(policy_hierarchy, allow_unicode=True, default_flow_style=False,
+                                          sort_keys=False, Dumper=NoAliasDumper)
+        logger.info('Found the following agent policy:\n%s', policy_hierarchy_yaml)
     return agent_gcp_projects, agent_policy_id
 
 
-# Returns a list of items that are in the primary list, but not the secondary list
-def get_list_diffs(primary_list: list, secondary_list: list):
+# Calls func for every item on the shared Fleet worker threads and returns the results in order.
+# The Fleet API calls are I/O bound, so the threads spend their time waiting on the network and the
+# round-trips overlap instead of running back to back.  Any exception raised by func is re-raised here.
+# func must not call run_concurrently() itself, the workers would end up waiting on each other
+def run_concurrently(func, items):
+    return list(fleet_executor.map(func, items))
+
+
+# Returns a list of items that are in the primary list, but not the secondary list.  Each membership check is
+# O(1): sets and dicts (checked against their keys) are used as is and any other container is turned into a set
+def get_list_diffs(primary_list: Iterable, secondary_list: Collection):
+    if not isinstance(secondary_list, (set, frozenset, dict)):
+        secondary_list = set(secondary_list)
     return [x for x in primary_list if x not in secondary_list]
 
 
-def is_key_in_list_dicts(target_list: list, key: str):
-    return next((d for i, d in enumerate(target_list) if key in d), None)
+# Send log records to stdout through a MemoryHandler.  Records are written once 1000 have been buffered, as soon
+# as an ERROR is logged, and when logging is shut down at exit.  The level comes from the optional LOG_LEVEL in the
+# .env file, records below it are dropped before their message is ever formatted
+def configure_logging():
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(logging.handlers.MemoryHandler(capacity=1000, flushLevel=logging.ERROR, target=stream_handler))
+    logger.propagate = False
+    log_level = os.environ.get("LOG_LEVEL", "INFO").upper()
+    try:
+        logger.setLevel(log_level)
+    except ValueError:
+        logger.setLevel(logging.INFO)
+        logger.warning('Unknown LOG_LEVEL %s in .env, using INFO', log_level)
 
 
-def is_kv_in_list_dicts(target_list: list, key: str, value: str):
-    return next((d for i, d in enumerate(target_list) if d[key] == value), None)
+# Variables that must be set (and not empty) in the .env file
+required_configuration = ("ELASTIC_API_KEY", "KIBANA_ENDPOINT", "MASTER_AGENT_POLICY_NAME", "GCP_QUOTA_PROJECT",
+                          "GCP_AGENT_TAG")
 
 
 # Check the .env file to make sure all required variables are set and formatted correctly
 def check_configuration():
     global api_key, endpoint, gcp_projects_to_ignore, api_http_headers, master_agent_policy_name, \
-           gcp_quota_project_name, gcp_agent_tag_name
-    try:
-        api_key = os.environ["ELASTIC_API_KEY"]
-        endpoint = os.environ["KIBANA_ENDPOINT"]
-        master_agent_policy_name = os.environ["MASTER_AGENT_POLICY_NAME"]
-        gcp_quota_project_name = os.environ["GCP_QUOTA_PROJECT"]
-        gcp_agent_tag_name = os.environ["GCP_AGENT_TAG"]
-    except KeyError as error:
-        print(f'Invalid configuration for .env!\n Error message: {error}\n')
+           gcp_quota_project_name, gcp_agent_tag_name, fleet_agents_url, agent_policies_url, package_policies_url
+    config = {name: os.environ.get(name) for name in required_configuration}
+    missing = [name for name, value in config.items() if not value]
+    if missing:
+        logger.error('Invalid configuration for .env!\n Missing required variables: %s', ', '.join(missing))
         exit(-1)
-    # This isn't a required variable
-    if "GCP_PROJECTS_TO_IGNORE" in os.environ:
-        gcp_projects_to_ignore = [os.environ["GCP_PROJECTS_TO_IGNORE"]]
-        if any(len(element) == 0 for element in gcp_projects_to_ignore) and len(gcp_projects_to_ignore) == 1:
-            gcp_projects_to_ignore = []
+    api_key = config["ELASTIC_API_KEY"]
+    endpoint = config["KIBANA_ENDPOINT"]
+    master_agent_policy_name = config["MASTER_AGENT_POLICY_NAME"]
+    gcp_quota_project_name = config["GCP_QUOTA_PROJECT"]
+    gcp_agent_tag_name = config["GCP_AGENT_TAG"]
+
+    # This isn't a required variable.  It is a comma separated list of GCP project IDs, blank entries are skipped
+    gcp_projects_to_ignore = [project.strip() for project in os.environ.get("GCP_PROJECTS_TO_IGNORE", "").split(",")
+                              if project.strip()]
 
     # Set global header for Elastic API requests
     api_http_headers = {"kbn-xsrf": "true",
                         "Content-Type": "application/json",
                         "Authorization": f"ApiKey {api_key}"}
+    s.headers.update(api_http_headers)
+
+    # Build the Kibana API URLs once instead of on every request
+    fleet_agents_url = f"{endpoint}/api/fleet/agents"
+    agent_policies_url = f"{endpoint}/api/fleet/agent_policies"
+    package_policies_url = f"{endpoint}/api/fleet/package_policies"
     return True
 
 
 def main():
     # Load and build configuration
     load_dotenv(override=True)
+    configure_logging()
     check_configuration()
+    load_master_policy_revision()
 
-    # Grab all the GCP projects which are active.  Make API call under the provided projects quota
-    projects = get_active_gcp_projects(quota_project_id=gcp_quota_project_name)
-
-    # Build a list of active GCP project IDs
-    active_gcp_projects = []
-    for project in projects:
-        active_gcp_projects.append(project.project_id)
-    print(f'\nGCP cloud *active* project IDs: {active_gcp_projects}\n')
+    # Grab all the GCP projects which are active (API call made under the provided projects quota) and the master
+    # agent policy's revision on the worker threads.  Neither depends on the agent policy, so they run while it is
+    # inspected and the slowest of the three sets the pace instead of their sum
+    active_gcp_projects_future = fleet_executor.submit(get_active_gcp_projects,
+                                                       quota_project_id=gcp_quota_project_name)
+    master_agent_policy_future = fleet_executor.submit(get_master_policy)
 
     # Inspect the current agent policy and provide the user a picture of what is deployed and where
     agent_gcp_projects, agent_policy_id = inspect_agent_policy()
 
+    active_gcp_projects = active_gcp_projects_future.result()
+    logger.info('GCP cloud *active* project IDs: %s', sorted(active_gcp_projects))
+
+    # Only the id and revision of the master agent policy are needed to tell whether the stored integration template
+    # is current and whether the existing integrations need updating, so just its summary was fetched
+    master_agent_policy = master_agent_policy_future.result()
+    master_policy_id = master_agent_policy['id']
+    master_policy_revision = master_agent_policy['revision']
+
+    # Each phase runs even if one before it failed for some projects, the failures have been logged already and
+    # the run exits with an error once they are all done
     # Create integrations for GCP projects that exist, but don't yet have integrations defined
-    create_integrations_by_gcp_project_id(agent_policy_id=agent_policy_id,
-                                          agent_gcp_projects=agent_gcp_projects,
-                                          active_gcp_projects=active_gcp_projects)
+    created = create_integrations_by_gcp_project_id(agent_policy_id=agent_policy_id,
+                                                    agent_gcp_projects=agent_gcp_projects,
+                                                    active_gcp_projects=active_gcp_projects,
+                                                    master_policy_id=master_policy_id,
+                                                    master_policy_revision=master_policy_revision)
 
     # Delete integrations for GCP projects that no longer exist
-    deleted_gcp_projects = delete_integrations_by_gcp_project_id(agent_gcp_projects=agent_gcp_projects,
-                                                                 active_gcp_projects=active_gcp_projects)
+    deleted_gcp_projects, deleted = delete_integrations_by_gcp_project_id(agent_gcp_projects=agent_gcp_projects,
+                                                                          active_gcp_projects=active_gcp_projects)
 
     # Roll out any changes made to the master integration policy (if any)
-    sync_master_integration(agent_policy_id=agent_policy_id,
-                            agent_gcp_projects=agent_gcp_projects,
-                            deleted_gcp_projects=deleted_gcp_projects)
-    cursor.close()
+    synced = sync_master_integration(agent_policy_id=agent_policy_id,
+                                     agent_gcp_projects=agent_gcp_projects,
+                                     deleted_gcp_projects=deleted_gcp_projects,
+                                     master_policy_id=master_policy_id,
+                                     master_policy_revision=master_policy_revision)
+    fleet_executor.shutdown()
     connection.close()
+    if not (created and deleted and synced):
+        logger.error('Synchronization finished with errors, see above')
+        exit(-1)
 
 
 if __name__ == "__main__":